@@ -1,11 +1,50 @@
 #!/bin/env python3
 # Use fluxengine software using greaseweazle hardware to probe a floppy in a drive
 import argparse
+import concurrent.futures
 import logging
+import mmap
 import os
+import struct
 import subprocess
 import tempfile
 
+# Fixed-offset byte signatures the probes look for, as (offset, pattern, tag)
+SIGNATURES = [
+    (0x1fe, b'\x55\xaa', 'pc_boot_sector'),
+    (0x000, b'\xeb', 'pc_boot_jump'),
+    (0x000, b'\xe9', 'pc_boot_jump'),
+    (0x000, b'LK', 'hfs_boot_block'),
+    (0x400, b'BD', 'hfs_volume'),
+    (0x400, b'\xd2\xd7', 'mfs_volume'),
+    (0x000, b'DOS', 'amiga_dos'),
+    (0x16500, b'\x12\x01', 'c1541_directory'),
+]
+
+# Total logical sectors for each IBM-PC format, by media size
+BPB_PROBES = {
+    '3.5': {'ibm1440': 2880, 'ibm720': 1440},
+    '5.25': {'ibm1200': 2400, 'ibm360': 720, 'ibm320': 640, 'ibm180': 360, 'ibm160': 320}
+}
+
+# Amiga filesystem types, by the DOS type at the start of the boot block
+AMIGA_FSTYPES = {
+    b'DOS\x00': 'amiga_ofs',
+    b'DOS\x01': 'amiga_ffs',
+    b'DOS\x02': 'amiga_ofs_international',
+    b'DOS\x03': 'amiga_ffs_international',
+    b'DOS\x04': 'amiga_ofs_international_dircache',
+    b'DOS\x05': 'amiga_ffs_international_dircache',
+}
+
+# How much of a track has_data() looks at, and the zeros it compares it to
+DATA_WINDOW = 4096
+ZERO_BLOCK = bytes(DATA_WINDOW)
+
+# Lookup tables for dump_data()
+HEX_BYTES = [f"{b:02x} " for b in range(256)]
+PRINTABLE = bytes(b if 32 <= b <= 127 else ord('.') for b in range(256))
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging")
@@ -22,15 +61,47 @@ def main():
         'drive': 0 if args.drive.lower() == 'a' else 1,
         'media_size': args.size,
         'forty_track': args.tracks == 40,
+        # decoded tracks, keyed by (decoder, cylinder), or None where the
+        # flux file couldn't be decoded
+        'tracks': {},
     }
 
-    for probe in (probe_bpb, probe_mac, probe_amiga, probe_c64):
-        format, filesystem = probe(fluxengine_params, args.debug)
-        if format is not None:
-            print(f"Format: {format}, Filesystem: {filesystem}")
-            exit(0)
+    # Reading the physical floppy is the slow part, so grab the flux for
+    # every cylinder the probes look at once and let the decoders work from
+    # that.  The commodore 1541 probe needs the directory track as well.
+    # An 80 track drive double-steps the 48tpi 5.25 formats, so the
+    # cylinders those decoders ask for aren't the physical ones that would
+    # be in the flux file; let fluxengine read the drive itself there.
+    if args.size == '5.25' and args.tracks == 80:
+        fluxengine_params['flux_file'] = None
+    else:
+        cylinders = (0, 17) if args.size == '5.25' else (0,)
+        fluxengine_params['flux_file'] = capture_flux(cylinders, fluxengine_params, args.debug)
 
-    print("Not a common format or it is corrupt")
+    # Only run the probes that can match this media size, most likely first.
+    # There are no 5.25 macintosh disks.  Not including the relatively rare
+    # A1020 drive, Amigas never used the 5.25 format -- and when they did,
+    # they'd format the drive as a DOS 360K Disk rather than the 440K Amiga
+    # format.  I don't have a sample of a 3.5 commodore 1581.
+    probes = {
+        '3.5': (probe_bpb, probe_mac, probe_amiga),
+        '5.25': (probe_bpb, probe_c64),
+    }
+
+    try:
+        for probe in probes[args.size]:
+            format, filesystem = probe(fluxengine_params, args.debug)
+            if format is not None:
+                print(f"Format: {format}, Filesystem: {filesystem}")
+                exit(0)
+
+        print("Not a common format or it is corrupt")
+    finally:
+        for data in fluxengine_params['tracks'].values():
+            if isinstance(data, mmap.mmap):
+                data.close()
+        if fluxengine_params['flux_file'] is not None:
+            os.unlink(fluxengine_params['flux_file'])
 
 
 def probe_bpb(fe_params, debug):
@@ -39,213 +110,300 @@ def probe_bpb(fe_params, debug):
     media which describes what format the media is.  So, read the first track and
     interpret the BPB
     """    
-    bpb_probes = {
-        '3.5': {'ibm1440': 2880, 'ibm720': 1440},
-        '5.25': {'ibm1200': 2400, 'ibm360': 720, 'ibm320': 640, 'ibm180': 360, 'ibm160': 320}
-    }
-    
+    total_sectors = BPB_PROBES[fe_params['media_size']]
+    formats = list(total_sectors)
+    if fe_params.get('flux_file') is not None:
+        # Decoding the captured flux is independent for each format, so run
+        # the decoders side by side.  Any that fail fall back to the drive
+        # below, one at a time and only if nothing has matched yet.
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(formats))
+        tracks = executor.map(lambda format: read_track(format, 0, fe_params, debug, use_drive=False), formats)
+    else:
+        # The drive can only do one read at a time, so only read the next
+        # format once the previous one didn't match.
+        executor = None
+        tracks = (read_track(format, 0, fe_params, debug) for format in formats)
     filesystem = None
-    for format in (bpb_probes[fe_params['media_size']]):
-        logging.debug(f"Probing for {format}")
-        data = read_track(format, 0, fe_params)
-        if not has_data(data):
-            logging.debug(f"Track appears empty.  Skipping")
-            continue        
-        if debug:
-            dump_data(data, 512)
-
-        if get_word(data, 0x1fe) == 0xaa55:
-            logging.debug("Found PC boot sector signature")
-            if data[0] in (0xeb, 0xe9):
-                logging.debug("Boot sector jump found")
-                #bpb_total_sectors = data[0x13] + data[0x14] * 256
-                bpb_total_sectors = get_word(data, 0x13)
-                logging.debug(f"Total logical sectors: {bpb_total_sectors}")
-                if bpb_total_sectors == bpb_probes[fe_params['media_size']][format]:            
-                    logging.debug(f"Correct total logical sectors for {format}")
-                    # now that we have a valid FAT-ish thing for this bpb, let's
-                    # figure out which specific FAT we have.  It's all based
-                    # on the number of clusters:  < 4085=FAT12, <65525=FAT16, else FAT32
-                    bpb_sectors_per_cluster = data[0x0d]
-                    if bpb_sectors_per_cluster not in (1, 2, 4, 8, 16, 32, 64, 128):
-                        logging.debug(f"Sectors per cluster has a bogus value: {bpb_sectors_per_cluster}")                        
-                        continue
-                    cluster_count = bpb_total_sectors / bpb_sectors_per_cluster
-                    logging.debug(f"FAT clusters on this disk: {cluster_count}")
-                    if cluster_count < 4085:
-                        filesystem = "fat12"
-                    elif cluster_count < 65525:
-                        filesystem = "fat16"
+    try:
+        for format, data in zip(formats, tracks):
+            logging.debug(f"Probing for {format}")
+            if data is None:
+                data = read_track(format, 0, fe_params, debug)
+            # check the signatures before scanning the whole track for data
+            signatures = find_signatures(data)
+            if 'pc_boot_sector' in signatures:
+                logging.debug("Found PC boot sector signature")
+                if debug:
+                    dump_data(data, 512)
+                if 'pc_boot_jump' in signatures:
+                    logging.debug("Boot sector jump found")
+                    #bpb_total_sectors = data[0x13] + data[0x14] * 256
+                    bpb_total_sectors = get_word(data, 0x13)
+                    logging.debug(f"Total logical sectors: {bpb_total_sectors}")
+                    if bpb_total_sectors == total_sectors[format]:            
+                        logging.debug(f"Correct total logical sectors for {format}")
+                        # now that we have a valid FAT-ish thing for this bpb, let's
+                        # figure out which specific FAT we have.  It's all based
+                        # on the number of clusters:  < 4085=FAT12, <65525=FAT16, else FAT32
+                        bpb_sectors_per_cluster = data[0x0d]
+                        # it has to be a power of two, no bigger than 128
+                        if (bpb_sectors_per_cluster == 0 or bpb_sectors_per_cluster > 128
+                                or bpb_sectors_per_cluster & (bpb_sectors_per_cluster - 1)):
+                            logging.debug(f"Sectors per cluster has a bogus value: {bpb_sectors_per_cluster}")                        
+                            continue
+                        cluster_count = bpb_total_sectors / bpb_sectors_per_cluster
+                        logging.debug(f"FAT clusters on this disk: {cluster_count}")
+                        if cluster_count < 4085:
+                            filesystem = "fat12"
+                        elif cluster_count < 65525:
+                            filesystem = "fat16"
+                        else:
+                            filesystem = "fat32"
+                        break
                     else:
-                        filesystem = "fat32"
-                    break
-                else:
-                    logging.warning(f"Logical sectors {bpb_total_sectors} indicates this is a {bpb_total_sectors / 2}K floppy")
+                        logging.warning(f"Logical sectors {bpb_total_sectors} indicates this is a {bpb_total_sectors / 2}K floppy")
+            elif not has_data(data):
+                logging.debug(f"Track appears empty.  Skipping")
+            else:
+                # without the signature we could actually be AtariST, MSX, or
+                # linux kernel floppies.  Probably no need to handle these at this
+                # time.
+                if debug:
+                    dump_data(data, 512)
         else:
-            # without the signature we could actually be AtariST, MSX, or
-            # linux kernel floppies.  Probably no need to handle these at this
-            # time.
-            pass
-    else:
-        format = None
-                    
+            format = None
+    finally:
+        if executor is not None:
+            # Every decode starts straight away, so this waits for all of
+            # them to finish, even after a match, before main() closes the
+            # cached tracks and unlinks the flux file.
+            executor.shutdown()
+
     return format, filesystem
 
 def probe_mac(fe_params, debug):
     "Probe mac formats"
-    if fe_params['media_size'] == '5.25':
-        # There are no 5.25 macintosh disks
-        return None, None    
-    
     # check for the 1.44M format floppy thing
-    data = read_track("ibm1440", 0, fe_params)
-    if has_data(data):
-        # test disk: f6's through 0x400.  At 0x400 4244  (that's the HFS Volume signature)
-        if get_word(data, 0x400, True) == 0x4244:
-            # this is the HFS master file directory signature
-            return "ibm1440", "hfs"
+    data = read_track("ibm1440", 0, fe_params, debug)
+    # test disk: f6's through 0x400.  At 0x400 4244  (that's the HFS Volume signature)
+    if 'hfs_volume' in find_signatures(data):
+        # this is the HFS master file directory signature
+        return "ibm1440", "hfs"
 
     # The only difference between mac400/mac800 is that one is
     # single-sided and the other double sided, but there's no way to
     # tell except through metadata.  Always read it as mac800 and then
     # use the filesystem metadata to determine the actual format.
-    data = read_track("mac800", 0, fe_params)
-    if not has_data(data):
-        logging.debug("No data found from mac800 read")
-        return None, None
-    if debug:
+    data = read_track("mac800", 0, fe_params, debug)
+    if debug and has_data(data):
         dump_data(data, 2048)
-    if get_word(data, 0, True) == 0x4c4b:
+    signatures = find_signatures(data)
+    if 'hfs_boot_block' in signatures:
         # this is an HFS boot block.  HFS was never used on 400K disks as near
         # as I understand.
         return "mac800", "hfs"
 
-    if get_word(data, 0x400, True) == 0x4244:
+    if 'hfs_volume' in signatures:
         # this is an HFS volume 
         return "mac800", "hfs"
 
-    if get_word(data, 0x400, True) == 0xd2d7:
+    if 'mfs_volume' in signatures:
         # The MFS was only used on 400K disks
         return "mac400", "mfs"
+
+    # only scan the whole track when none of the signatures matched
+    if not has_data(data):
+        logging.debug("No data found from mac800 read")
+        return None, None
     
     return "mac800", None
     
  
 
 def probe_amiga(fe_params, debug):
-    if fe_params['media_size'] == '5.25':
-        # Not including the relatively rare A1020 drive, Amigas never
-        # used the 5.25 format -- and when they did, they'd format
-        # the drive as a DOS 360K Disk rather than the 440K Amiga
-        # format.
-        return None, None
-    data = read_track('amiga', 0, fe_params)
-    if not has_data(data):        
+    data = read_track('amiga', 0, fe_params, debug)
+    if 'amiga_dos' not in find_signatures(data) and not has_data(data):
         logging.debug(f"Amiga Track appears empty.  Skipping")
         return None, None
 
     if debug:
         dump_data(data, 512)
-    fstype = get_string(data, 0, 4)
-    fstypes = {"DOS\0": "amiga_ofs",
-               "DOS\x01": "amiga_ffs",
-               "DOS\x02": "amiga_ofs_international",
-               "DOS\x03": "amiga_ffs_international",
-               "DOS\x04": "amiga_ofs_international_dircache",
-               "DOS\x05": "amiga_ffs_international_dircache"}
     # The amiga encoding is unique enough that if we got any data then
     # it's probably really an amiga disk.  Many games didn't have a
     # valid filesystem, so a filesystem type of None is a legitimate response
-    return "amiga", fstypes.get(fstype, None)
+    return "amiga", AMIGA_FSTYPES.get(data[0:4], None)
     
 
 def probe_c64(fe_params, debug):
     "probe c64 formats"
-    if fe_params['media_size'] == '5.25':
-        # look for 1541 format, possibly 1571 in the future
-        data = read_track("commodore1541", 17, fe_params)
-        if has_data(data):
-            logging.debug("Looks like c1541 encoding")
-            if debug:            
-                dump_data(data)
-            if data[0x16500] == 0x12 and data[0x16501] == 0x01:
-                logging.debug("directory block pointer valid")
-                if get_string(data, 0x165a5, 2) == '2A':
-                    logging.debug("Disk format correct")
-                    return "commodore1541", "2A"
-    else:
-        # I don't have a sample of 1581.
-        pass
+    # look for 1541 format, possibly 1571 in the future
+    data = read_track("commodore1541", 17, fe_params, debug)
+    # only the track we asked for has been decoded
+    if debug and has_data(data, 0x16500):
+        dump_data(data)
+    if 'c1541_directory' in find_signatures(data):
+        logging.debug("directory block pointer valid")
+        if get_string(data, 0x165a5, 2) == '2A':
+            logging.debug("Disk format correct")
+            return "commodore1541", "2A"
+    elif has_data(data, 0x16500):
+        logging.debug("Looks like c1541 encoding, but no directory block pointer")
     return None, None
 
-def has_data(data):
-    "Return true if there is some data here"
-    return len([x for x in data if x != 0]) > 0
+def find_signatures(data):
+    "Return the tags of all of the SIGNATURES found in the data"
+    return {tag for offset, pattern, tag in SIGNATURES
+            if data[offset:offset + len(pattern)] == pattern}
+
+def has_data(data, offset=0):
+    """
+    Return true if there is some data in the DATA_WINDOW bytes at offset.
+    Every format we probe for puts its signatures near the start of the
+    track that was read, so the first page is enough to tell if the track
+    is empty.
+    """
+    # A single memcmp against zeros, and slicing works the same whether data
+    # is bytes or an mmap.
+    block = data[offset:offset + DATA_WINDOW]
+    return block != ZERO_BLOCK[:len(block)]
 
 def get_string(data, offset, length):
     "get an ascii string of length from the data at offset"
-    buffer = ""
-    for i in range(offset, offset + length):
-        buffer += chr(data[i])
-    return buffer
+    # latin-1 maps every byte straight to the same code point, like chr()
+    return data[offset:offset + length].decode('latin-1')
 
 
 def get_word(data, offset, big_endian=False):
     "Get a word in the data at the given offset, optionally decoded big_endian"
-    if big_endian:
-        return data[offset] * 256 + data[offset + 1]
-    else:
-        return data[offset] + data[offset + 1] * 256
+    return struct.unpack_from('>H' if big_endian else '<H', data, offset)[0]
 
 def get_dword(data, offset, big_endian=False):
     "Get a dword in the data at the given offset, optionally decoded big_endian"
-    if big_endian:
-        return get_word(data, offset, True) * 65536 + get_word(data, offset + 2, True)
-    else:
-        return get_word(data, offset) + get_word(data, offset + 2) * 65536
+    return struct.unpack_from('>I' if big_endian else '<I', data, offset)[0]
 
-def read_track(decoder, cylinder, fe_params):
-    "Build a commandline for fluxengine and read a single track from the drive"
-    args = ['fluxengine', 'read', decoder]
+def run_fluxengine(args, debug):
+    """
+    Run fluxengine with the given args.  Its progress output is only kept
+    when debugging, otherwise it goes straight to /dev/null.  The errors on
+    stderr are always kept.
+    """
+    logging.debug(f"Fluxengine commandline: {args}")
+    if debug:
+        return subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf8')
+    return subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding='utf8')
+
+def fluxengine_output(p):
+    "Get the fluxengine output for an error message"
+    if p.stdout is None:
+        return p.stderr
+    return p.stdout
+
+def capture_flux(cylinders, fe_params, debug):
+    """
+    Read the raw flux for the given cylinders from the drive into a flux file
+    so that each decoder can be run against it without touching the drive
+    again.  Returns the name of the flux file, or None if it couldn't be read.
+    Decoding from the flux file can't retry by re-reading the drive, so grab
+    a few revolutions to give the decoders some redundant data to work with.
+    """
+    args = ['fluxengine', 'rawread']
     if fe_params['forty_track']:
         args.append('40track_drive')
-    tmpfile = tempfile.mktemp() + ".img"
+    fd, fluxfile = tempfile.mkstemp(suffix=".flux")
+    os.close(fd)
     args.extend([f'-s', f"drive:{fe_params['drive']}",
-                 '--output', tmpfile,
-                 '--cylinders', str(cylinder),
-                 '--decoder.retries=6'])
-    logging.debug(f"Fluxengine commandline: {args}")
-    p = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf8')
+                 '-d', fluxfile,
+                 '--cylinders', ','.join(str(c) for c in cylinders),
+                 '--drive.revolutions=5'])
+    p = run_fluxengine(args, debug)
+    if p.returncode != 0:
+        logging.warning(f"Couldn't capture flux with {args}: rc={p.returncode}\n{fluxengine_output(p)}")
+        logging.warning("Reading the drive directly for each decoder instead")
+        os.unlink(fluxfile)
+        return None
+    return fluxfile
+
+def read_track(decoder, cylinder, fe_params, debug, use_drive=True):
+    """
+    Read a single track, decoding it from the captured flux file if there is
+    one, or from the drive itself when there isn't or the decode fails.  Each
+    decoder/cylinder pair is only decoded once, since every fluxengine run
+    pays its startup cost all over again.  A track that couldn't be read
+    comes back as b''.  With use_drive False, a failed flux decode returns
+    None instead of falling back to the drive.
+    """
+    key = (decoder, cylinder)
+    if fe_params['tracks'].get(key) is not None:
+        logging.debug(f"Using previously decoded {decoder} cylinder {cylinder}")
+        return fe_params['tracks'][key]
+
+    data = None
+    # a None in the cache means decoding the flux has already failed
+    if fe_params.get('flux_file') is not None and key not in fe_params['tracks']:
+        data = decode_track(decoder, cylinder, ['-s', fe_params['flux_file']], fe_params, debug)
+        if data is None:
+            if not use_drive:
+                fe_params['tracks'][key] = None
+                return None
+            logging.warning(f"Couldn't decode {decoder} from the captured flux, reading the drive instead")
+    if data is None:
+        data = decode_track(decoder, cylinder,
+                            ['-s', f"drive:{fe_params['drive']}", '--decoder.retries=6'],
+                            fe_params, debug)
+    if data is None:
+        logging.error(f"Couldn't read {decoder} cylinder {cylinder}")
+        data = b''
+    fe_params['tracks'][key] = data
+    return data
+
+def decode_track(decoder, cylinder, source, fe_params, debug):
+    """
+    Build a commandline for fluxengine and decode a single track from the
+    given source arguments.  Returns None if fluxengine failed or didn't
+    produce an image.
+    """
+    args = ['fluxengine', 'read', decoder]
+    if fe_params['forty_track']:
+        args.append('40track_drive')
+    # fluxengine picks the image writer from the output file extension, so
+    # it has to be a real .img file rather than a pipe
+    fd, tmpfile = tempfile.mkstemp(suffix=".img")
+    os.close(fd)
+    args.extend(source)
+    args.extend(['--output', tmpfile,
+                 '--cylinders', str(cylinder)])
+    p = run_fluxengine(args, debug)
+    data = None
     if p.returncode == 0:
+        # The probes only look at a few offsets, so map the image rather than
+        # reading all of it and let the kernel page in what actually gets
+        # used.  The mapping outlives the file; it's kept in the track cache
+        # and unmapped when main() is done.  Windows won't unlink a file
+        # that's still mapped, so just read it there.
         with open(tmpfile, 'rb') as f:
-            data = f.read()
-        os.unlink(tmpfile)
+            if os.fstat(f.fileno()).st_size == 0:
+                pass
+            elif os.name == 'posix':
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
     else:
-        data = ''
-        logging.error(f"Couldn't run {args}: rc={p.returncode}\n{p.stdout}")
-    return bytearray(data)
+        logging.warning(f"Couldn't run {args}: rc={p.returncode}\n{fluxengine_output(p)}")
+    os.unlink(tmpfile)
+    return data
 
 def dump_data(data, limit=None):
-    addr = 0
-    buffer = ''
     if limit is None:
         limit = len(data)
+    limit = min(limit, len(data))
 
-    for b in data:
-        if addr >= limit:
-            break
-        if addr % 16 == 0:
-            print(f"{addr:04x} ", end='')        
-        print(f"{b:02x} ", end='')              
-        buffer += chr(b) if 32 <= b <= 127 else '.'
-
-        if addr % 16 == 15:
-            print(f"  {buffer}")
-            buffer = ""
-        addr = addr + 1
-
-    if buffer:
-        print(f"  {buffer}")
+    lines = []
+    for addr in range(0, limit, 16):
+        chunk = data[addr:min(addr + 16, limit)]
+        hex_bytes = ''.join(HEX_BYTES[b] for b in chunk)
+        lines.append(f"{addr:04x} {hex_bytes:<48}  {chunk.translate(PRINTABLE).decode('latin-1')}")
+    if lines:
+        print('\n'.join(lines))
 
 
 if __name__ == "__main__":